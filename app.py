@@ -1,15 +1,72 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, jsonify, g
 import secrets
 import os
+import io
+import logging
+import time
+import uuid
 
 # Import our custom modules
-from database import init_database, save_pdf_to_db, get_pdf_by_id, get_pdf_file_path, get_all_pdfs, get_database_stats
-from file_handler import setup_upload_folder, save_uploaded_file
+from database import init_database, save_pdf_to_db, get_pdf_by_id, get_pdf_file_path, get_all_pdfs, get_database_stats, DATABASE_NAME
+from file_handler import setup_upload_folder, save_uploaded_file, UPLOAD_FOLDER
+import profiler
+import structured_log
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY') or secrets.token_hex(16)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 
+REQUEST_ID_HEADER = 'X-Request-ID'
+
+@app.before_request
+def start_request_log():
+    """Give each request an ID that is attached to every log record it produces"""
+    g.request_id = request.headers.get(REQUEST_ID_HEADER, '')[:64] or uuid.uuid4().hex
+    g.request_start = time.perf_counter()
+    rule = request.url_rule.rule if request.url_rule else None
+    structured_log.bind_request(g.request_id, rule)
+
+@app.after_request
+def log_request(response):
+    """Queue one JSON record per request with its latency and size (errors are never sampled out)"""
+    latency_ms = (time.perf_counter() - g.request_start) * 1000
+    structured_log.log_event(
+        'request',
+        force=response.status_code >= 500,
+        method=request.method,
+        path=request.path,
+        status=response.status_code,
+        latency_ms=round(latency_ms, 3),
+        bytes_in=request.content_length or 0,
+        bytes_out=response.content_length,
+    )
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+@app.teardown_request
+def finish_request_log(exc):
+    structured_log.clear_request()
+
+@app.before_request
+def start_request_profile():
+    """Profile sampled, slow or explicitly requested (X-Profile header) requests"""
+    if request.path.startswith('/admin/profiles'):
+        return
+    rule = request.url_rule.rule if request.url_rule else None
+    g.profile_id = profiler.start_request(request.method, request.path, rule,
+                                            request.headers.get(profiler.PROFILE_HEADER))
+
+@app.after_request
+def tag_request_profile(response):
+    profiler.set_response_status(response.status_code)
+    if g.get('profile_id'):
+        response.headers['X-Profile-Id'] = str(g.profile_id)
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc):
+    profiler.finish_request()
+
 @app.route("/")
 def upload_form():
     return render_template('upload.html')
@@ -83,6 +140,72 @@ def admin_db():
     <br><a href="/">Back to Upload</a> | <a href="/list">View PDFs</a>
     """
 
+def profile_token_error():
+    """Return a 403 response unless the request carries the X-Profile token"""
+    if not profiler.token_matches(request.headers.get(profiler.PROFILE_HEADER)):
+        return jsonify({"error": "Profiling token required"}), 403
+    return None
+
+@app.route("/admin/profiles")
+def admin_profiles():
+    """JSON list of captured request profiles (newest first, requires the X-Profile token)"""
+    error = profile_token_error()
+    if error:
+        return error
+    
+    return jsonify({'config': profiler.get_config(), 'profiles': profiler.list_profiles()})
+
+@app.route("/admin/profiles/<int:profile_id>")
+def admin_profile_download(profile_id):
+    """Download a captured profile with its SQL statements and stacks as JSON"""
+    error = profile_token_error()
+    if error:
+        return error
+    
+    profile = profiler.get_profile(profile_id)
+    if not profile:
+        return "Profile not found", 404
+    
+    data = {key: value for key, value in profile.items() if key != 'pstats'}
+    response = jsonify(data)
+    response.headers['Content-Disposition'] = f'attachment; filename=profile-{profile_id}.json'
+    return response
+
+@app.route("/admin/profiles/<int:profile_id>.prof")
+def admin_profile_pstats(profile_id):
+    """Download the raw cProfile data, loadable with pstats or snakeviz"""
+    error = profile_token_error()
+    if error:
+        return error
+    
+    profile = profiler.get_profile(profile_id)
+    if not profile or not profile['pstats']:
+        return "Profile not found", 404
+    
+    return send_file(io.BytesIO(profile['pstats']), mimetype='application/octet-stream',
+                     as_attachment=True, download_name=f'profile-{profile_id}.prof')
+
+@app.route("/admin/profiles/config", methods=['POST'])
+def admin_profiles_config():
+    """Change profiling settings without restarting (requires the X-Profile token)"""
+    error = profile_token_error()
+    if error:
+        return error
+    
+    settings = request.get_json(silent=True) or {}
+    if not isinstance(settings, dict):
+        return jsonify({"error": "Settings must be a JSON object"}), 400
+    try:
+        config = profiler.configure(
+            sample_rate=settings.get('sample_rate'),
+            mode=settings.get('mode'),
+            slow_request_ms=settings.get('slow_request_ms'),
+            buffer_size=settings.get('buffer_size'),
+        )
+    except (TypeError, ValueError, OverflowError) as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify(config)
+
 @app.route("/api/stats")
 def api_stats():
     """JSON API endpoint for database statistics"""
@@ -99,9 +222,10 @@ if __name__ == "__main__":
     setup_upload_folder()
     init_database()
     
-    print("🚀 PDF Upload App Starting...")
-    print("📁 Database: pdfs.db")
-    print("📂 Upload folder: uploads/")
-    print("🌐 Server: http://localhost:8080")
+    # The request records from structured_log replace werkzeug's synchronous access log
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    
+    structured_log.log_event('app_started', database=DATABASE_NAME, upload_folder=UPLOAD_FOLDER,
+                             url='http://localhost:8080')
     
     app.run(host='0.0.0.0', port=8080)
\ No newline at end of file
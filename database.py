@@ -1,11 +1,21 @@
 import sqlite3
 import os
 
+import profiler
+from structured_log import log_event
+
 DATABASE_NAME = 'pdfs.db'
 
+def get_connection():
+    """Open a database connection, recording executed SQL if the current request is profiled"""
+    conn = sqlite3.connect(DATABASE_NAME)
+    if profiler.is_recording():
+        conn.set_trace_callback(profiler.record_sql)
+    return conn
+
 def init_database():
     """Create the database and tables if they don't exist"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS pdfs (
@@ -18,11 +28,11 @@ def init_database():
     ''')
     conn.commit()
     conn.close()
-    print("Database initialized successfully")
+    log_event('database_initialized', database=DATABASE_NAME)
 
 def save_pdf_to_db(filename, original_filename, file_path):
     """Save PDF information to database and return the new PDF ID"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('''
         INSERT INTO pdfs (filename, original_filename, file_path)
@@ -31,12 +41,12 @@ def save_pdf_to_db(filename, original_filename, file_path):
     conn.commit()
     pdf_id = cursor.lastrowid
     conn.close()
-    print(f"PDF saved to database with ID: {pdf_id}")
+    log_event('pdf_saved', pdf_id=pdf_id)
     return pdf_id
 
 def get_pdf_by_id(pdf_id):
     """Get PDF information by ID"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM pdfs WHERE id = ?', (pdf_id,))
     pdf = cursor.fetchone()
@@ -45,7 +55,7 @@ def get_pdf_by_id(pdf_id):
 
 def get_pdf_file_path(pdf_id):
     """Get just the file path for a PDF by ID"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT file_path FROM pdfs WHERE id = ?', (pdf_id,))
     result = cursor.fetchone()
@@ -54,7 +64,7 @@ def get_pdf_file_path(pdf_id):
 
 def get_all_pdfs():
     """Get all PDFs ordered by upload date (newest first)"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     cursor.execute('SELECT * FROM pdfs ORDER BY upload_date DESC')
     pdfs = cursor.fetchall()
@@ -63,7 +73,7 @@ def get_all_pdfs():
 
 def get_database_stats():
     """Get database statistics"""
-    conn = sqlite3.connect(DATABASE_NAME)
+    conn = get_connection()
     cursor = conn.cursor()
     
     # Get table info and format it nicely
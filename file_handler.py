@@ -1,13 +1,15 @@
 import os
 from werkzeug.utils import secure_filename
 
+from structured_log import log_event
+
 UPLOAD_FOLDER = 'uploads'
 ALLOWED_EXTENSIONS = {'pdf'}
 
 def setup_upload_folder():
     """Create upload folder if it doesn't exist"""
     os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    print(f"Upload folder '{UPLOAD_FOLDER}' ready")
+    log_event('upload_folder_ready', folder=UPLOAD_FOLDER)
 
 def is_allowed_file(filename):
     """Check if file has allowed extension (PDF only)"""
@@ -27,6 +29,6 @@ def save_uploaded_file(file):
     
     # Save file to disk
     file.save(file_path)
-    print(f"File saved: {file_path}")
+    log_event('file_saved', file_path=file_path)
     
     return filename, file_path
\ No newline at end of file
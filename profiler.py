@@ -0,0 +1,312 @@
+import cProfile
+import hmac
+import io
+import itertools
+import marshal
+import math
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+# Profiling is opt-in: everything is off unless one of these is configured
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', '0'))  # fraction of requests, 0.0 - 1.0
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sampling')  # 'sampling' or 'cprofile'
+SLOW_REQUEST_MS = float(os.environ.get('PROFILE_SLOW_REQUEST_MS', '0'))  # 0 disables slow capture
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')  # required for the admin header and config changes
+PROFILE_HEADER = 'X-Profile'
+SAMPLE_INTERVAL_MS = float(os.environ.get('PROFILE_SAMPLE_INTERVAL_MS', '5'))
+BUFFER_SIZE = int(os.environ.get('PROFILE_BUFFER_SIZE', '50'))
+MAX_BUFFER_SIZE = 10000
+MAX_SQL_STATEMENTS = 500
+MAX_STACK_DEPTH = 64
+PROFILE_MODES = ('sampling', 'cprofile')
+
+_local = threading.local()
+_profiles = deque(maxlen=BUFFER_SIZE)
+_profiles_lock = threading.Lock()
+_profile_ids = itertools.count(1)
+
+# Requests whose stacks the sampler thread should collect, keyed by thread id
+_sampled_requests = {}
+_sampled_lock = threading.Lock()
+_sampler_thread = None
+
+# Only one cProfile profiler can be active per process on newer Pythons
+_cprofile_lock = threading.Lock()
+
+
+def token_matches(value):
+    """Check a client supplied value against PROFILE_TOKEN (never matches if no token is set)"""
+    if not PROFILE_TOKEN or not value:
+        return False
+    return hmac.compare_digest(value.encode(), PROFILE_TOKEN.encode())
+
+
+def start_request(method, path, route=None, profile_token=None):
+    """Start tracking the current request and return its profile ID if it will be profiled"""
+    requested = token_matches(profile_token)
+    sampled = not requested and PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+    if not (requested or sampled or SLOW_REQUEST_MS > 0):
+        _local.state = None
+        return None
+
+    state = {
+        'id': next(_profile_ids) if requested or sampled else None,
+        'reason': 'requested' if requested else 'sampled' if sampled else None,
+        'mode': PROFILE_MODE if requested or sampled else 'sampling',
+        'method': method,
+        'path': path,
+        'route': route,
+        'status': None,
+        'started_at': time.time(),
+        'start': time.perf_counter(),
+        'thread_id': threading.get_ident(),
+        'profile': None,
+        'stacks': Counter(),
+        'sql': [],
+    }
+
+    if state['mode'] == 'cprofile':
+        state['profile'] = _start_cprofile()
+        if state['profile'] is None:
+            # Another request holds the profiler, fall back to stack sampling
+            state['mode'] = 'sampling'
+
+    if state['mode'] == 'sampling':
+        with _sampled_lock:
+            _sampled_requests[state['thread_id']] = state
+            _ensure_sampler()
+
+    _local.state = state
+    return state['id']
+
+
+def set_response_status(status_code):
+    """Remember the response status for the current request"""
+    state = getattr(_local, 'state', None)
+    if state is not None:
+        state['status'] = status_code
+
+
+def finish_request():
+    """Stop tracking the current request and keep its profile if it was profiled or slow"""
+    state = getattr(_local, 'state', None)
+    if state is None:
+        return None
+    _local.state = None
+
+    duration_ms = (time.perf_counter() - state['start']) * 1000
+
+    profile = state['profile']
+    if profile is not None:
+        profile.disable()
+        _cprofile_lock.release()
+
+    with _sampled_lock:
+        _sampled_requests.pop(state['thread_id'], None)
+        stacks = dict(state['stacks'])
+
+    reason = state['reason']
+    if reason is None and SLOW_REQUEST_MS > 0 and duration_ms >= SLOW_REQUEST_MS:
+        reason = 'slow'
+        state['id'] = next(_profile_ids)
+    if reason is None:
+        return None
+
+    record = {
+        'id': state['id'],
+        'reason': reason,
+        'mode': state['mode'],
+        'method': state['method'],
+        'path': state['path'],
+        'route': state['route'],
+        'status': state['status'],
+        'started_at': state['started_at'],
+        'duration_ms': round(duration_ms, 3),
+        'sql': state['sql'],
+        'stacks': _fold_stacks(stacks),
+        'report': None,
+        'pstats': None,
+    }
+    if profile is not None:
+        record['report'], record['pstats'] = _summarize_cprofile(profile)
+
+    with _profiles_lock:
+        _profiles.append(record)
+    return record['id']
+
+
+def is_recording():
+    """Return True if SQL executed on this thread should be recorded"""
+    return getattr(_local, 'state', None) is not None
+
+
+def record_sql(statement):
+    """sqlite3 trace callback that attaches executed SQL to the current request"""
+    state = getattr(_local, 'state', None)
+    if state is not None and len(state['sql']) < MAX_SQL_STATEMENTS:
+        state['sql'].append({
+            'offset_ms': round((time.perf_counter() - state['start']) * 1000, 3),
+            'statement': statement,
+        })
+
+
+def list_profiles():
+    """Summaries of the captured profiles, newest first"""
+    with _profiles_lock:
+        records = list(_profiles)
+    return [{
+        'id': record['id'],
+        'reason': record['reason'],
+        'mode': record['mode'],
+        'method': record['method'],
+        'path': record['path'],
+        'route': record['route'],
+        'status': record['status'],
+        'started_at': record['started_at'],
+        'duration_ms': record['duration_ms'],
+        'sql_statements': len(record['sql']),
+        'samples': sum(record['stacks'].values()),
+    } for record in reversed(records)]
+
+
+def get_profile(profile_id):
+    """Get a captured profile by ID, or None if it has been evicted"""
+    with _profiles_lock:
+        for record in _profiles:
+            if record['id'] == profile_id:
+                return record
+    return None
+
+
+def clear_profiles():
+    """Drop every captured profile"""
+    with _profiles_lock:
+        _profiles.clear()
+
+
+def get_config():
+    """Current profiling settings"""
+    return {
+        'sample_rate': PROFILE_SAMPLE_RATE,
+        'mode': PROFILE_MODE,
+        'slow_request_ms': SLOW_REQUEST_MS,
+        'sample_interval_ms': SAMPLE_INTERVAL_MS,
+        'buffer_size': _profiles.maxlen,
+        'header_enabled': bool(PROFILE_TOKEN),
+    }
+
+
+def configure(sample_rate=None, mode=None, slow_request_ms=None, buffer_size=None):
+    """Change profiling settings at runtime, raising ValueError for invalid values"""
+    global PROFILE_SAMPLE_RATE, PROFILE_MODE, SLOW_REQUEST_MS, _profiles
+
+    sample_rate = _setting_number('sample_rate', sample_rate)
+    slow_request_ms = _setting_number('slow_request_ms', slow_request_ms)
+    buffer_size = _setting_number('buffer_size', buffer_size, integral=True)
+
+    if sample_rate is not None and not 0 <= sample_rate <= 1:
+        raise ValueError('sample_rate must be between 0 and 1')
+    if mode is not None and mode not in PROFILE_MODES:
+        raise ValueError(f"mode must be one of {', '.join(PROFILE_MODES)}")
+    if slow_request_ms is not None and slow_request_ms < 0:
+        raise ValueError('slow_request_ms must not be negative')
+    if buffer_size is not None and not 1 <= buffer_size <= MAX_BUFFER_SIZE:
+        raise ValueError(f'buffer_size must be between 1 and {MAX_BUFFER_SIZE}')
+
+    if sample_rate is not None:
+        PROFILE_SAMPLE_RATE = sample_rate
+    if mode is not None:
+        PROFILE_MODE = mode
+    if slow_request_ms is not None:
+        SLOW_REQUEST_MS = slow_request_ms
+    if buffer_size is not None:
+        with _profiles_lock:
+            _profiles = deque(_profiles, maxlen=buffer_size)
+    return get_config()
+
+
+def _setting_number(name, value, integral=False):
+    """Validate a numeric setting, returning a float (or int if integral) or None if unset"""
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise ValueError(f'{name} must be a number')
+    try:
+        number = float(value)
+    except OverflowError:
+        raise ValueError(f'{name} must be finite')
+    if not math.isfinite(number):
+        raise ValueError(f'{name} must be finite')
+    if integral:
+        if not number.is_integer():
+            raise ValueError(f'{name} must be a whole number')
+        return int(value)
+    return number
+
+
+def _start_cprofile():
+    """Enable cProfile for the current thread, or return None if it is busy"""
+    if not _cprofile_lock.acquire(blocking=False):
+        return None
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+    except ValueError:
+        # Some other profiling tool is already registered
+        _cprofile_lock.release()
+        return None
+    return profile
+
+
+def _summarize_cprofile(profile):
+    """Return a text report and the raw pstats dump for a finished profile"""
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats('cumulative').print_stats(40)
+    profile.create_stats()
+    return stream.getvalue(), marshal.dumps(profile.stats)
+
+
+def _ensure_sampler():
+    """Start the stack sampler thread if it is not running (call with _sampled_lock held)"""
+    global _sampler_thread
+    if _sampler_thread is None:
+        _sampler_thread = threading.Thread(target=_sample_stacks, name='request-profiler', daemon=True)
+        _sampler_thread.start()
+
+
+def _sample_stacks():
+    """Periodically record the stack of every request being sampled, exiting when idle"""
+    global _sampler_thread
+    while True:
+        time.sleep(SAMPLE_INTERVAL_MS / 1000)
+        frames = sys._current_frames()
+        with _sampled_lock:
+            if not _sampled_requests:
+                _sampler_thread = None
+                return
+            for thread_id, state in _sampled_requests.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    state['stacks'][_stack_key(frame)] += 1
+
+
+def _stack_key(frame):
+    """Collapse a frame into a root-first 'file:function;...' key"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        names.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+def _fold_stacks(stacks):
+    """Order collapsed stacks by sample count (flamegraph folded format)"""
+    return dict(sorted(stacks.items(), key=lambda item: item[1], reverse=True))
@@ -0,0 +1,182 @@
+import atexit
+import json
+import os
+import queue
+import random
+import sys
+import threading
+import time
+
+# Records are queued and written by a background thread, so request handling
+# never waits on stdout. When the buffer is full new records are dropped.
+LOG_BUFFER_SIZE = int(os.environ.get('LOG_BUFFER_SIZE', '10000'))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', '256'))
+LOG_FLUSH_INTERVAL_MS = float(os.environ.get('LOG_FLUSH_INTERVAL_MS', '100'))
+LOG_RATE_LIMIT = int(os.environ.get('LOG_RATE_LIMIT', '1000'))  # records per event per second, 0 disables
+LOG_STREAM = None  # defaults to sys.stdout at write time
+
+
+def _parse_sample_rates(value):
+    """Parse 'event=rate,event=rate' into a dict"""
+    rates = {}
+    for item in value.split(','):
+        if '=' in item:
+            event, rate = item.split('=', 1)
+            rates[event.strip()] = float(rate)
+    return rates
+
+
+# Fraction of records kept per event, e.g. LOG_SAMPLE_RATES="request=0.1"
+SAMPLE_RATES = _parse_sample_rates(os.environ.get('LOG_SAMPLE_RATES', ''))
+
+_queue = queue.Queue(maxsize=LOG_BUFFER_SIZE)
+_local = threading.local()
+_writer_thread = None
+_writer_lock = threading.Lock()
+
+# Counters are only touched under _stats_lock
+_stats_lock = threading.Lock()
+_dropped = 0
+_suppressed = {}
+_rate_windows = {}
+
+
+class _FlushMarker:
+    """Queue entry that is signalled once every record queued before it is written"""
+
+    def __init__(self):
+        self.done = threading.Event()
+
+
+def bind_request(request_id, route=None):
+    """Attach a request ID and route to every record logged on this thread"""
+    _local.context = {'request_id': request_id, 'route': route}
+
+
+def clear_request():
+    """Forget the request context for this thread"""
+    _local.context = None
+
+
+def log_event(event, force=False, **fields):
+    """Queue a JSON log record without blocking; return False if it was sampled, limited or dropped
+
+    force=True skips sampling and rate limiting (the record can still be dropped
+    if the buffer is full).
+    """
+    global _dropped
+
+    if not force:
+        sample_rate = SAMPLE_RATES.get(event, 1.0)
+        if sample_rate < 1.0 and random.random() >= sample_rate:
+            return False
+
+    now = time.time()
+    suppressed = 0
+    with _stats_lock:
+        if not force and LOG_RATE_LIMIT > 0:
+            window = _rate_windows.get(event)
+            if window is None or now - window[0] >= 1.0:
+                window = _rate_windows[event] = [now, 0]
+            if window[1] >= LOG_RATE_LIMIT:
+                _suppressed[event] = _suppressed.get(event, 0) + 1
+                return False
+            window[1] += 1
+        suppressed = _suppressed.pop(event, 0)
+
+    record = {'ts': round(now, 3), 'event': event}
+    context = getattr(_local, 'context', None)
+    if context:
+        record.update(context)
+    record.update(fields)
+    if suppressed:
+        record['suppressed'] = suppressed
+
+    _ensure_writer()
+    try:
+        _queue.put_nowait(record)
+    except queue.Full:
+        with _stats_lock:
+            _dropped += 1
+        return False
+    return True
+
+
+def flush(timeout=1.0):
+    """Wait until every record queued so far has been written; return False on timeout"""
+    _ensure_writer()
+    marker = _FlushMarker()
+    try:
+        _queue.put(marker, timeout=timeout)
+    except queue.Full:
+        return False
+    return marker.done.wait(timeout)
+
+
+def get_stats():
+    """Counters for the logging pipeline"""
+    with _stats_lock:
+        return {
+            'queued': _queue.qsize(),
+            'dropped': _dropped,
+            'suppressed': sum(_suppressed.values()),
+        }
+
+
+def _ensure_writer():
+    """Start the background writer thread if it is not running"""
+    global _writer_thread
+    if _writer_thread is None:
+        with _writer_lock:
+            if _writer_thread is None:
+                _writer_thread = threading.Thread(target=_write_loop, name='structured-log', daemon=True)
+                _writer_thread.start()
+
+
+def _write_loop():
+    """Collect queued records into batches and write each batch with a single flush"""
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + LOG_FLUSH_INTERVAL_MS / 1000
+        while len(batch) < LOG_BATCH_SIZE and not isinstance(batch[-1], _FlushMarker):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _write_batch(batch)
+
+
+def _write_batch(batch):
+    """Serialize and write a batch of records, then signal any flush markers in it"""
+    global _dropped
+
+    with _stats_lock:
+        dropped, _dropped = _dropped, 0
+
+    lines = []
+    markers = []
+    for entry in batch:
+        if isinstance(entry, _FlushMarker):
+            markers.append(entry)
+        else:
+            lines.append(json.dumps(entry, default=str))
+    if dropped:
+        lines.append(json.dumps({'ts': round(time.time(), 3), 'event': 'log_dropped', 'count': dropped}))
+
+    if lines:
+        stream = LOG_STREAM or sys.stdout
+        try:
+            stream.write('\n'.join(lines) + '\n')
+            stream.flush()
+        except (OSError, ValueError):
+            # stdout is gone or closed, nothing useful left to do with the batch
+            pass
+
+    for marker in markers:
+        marker.done.set()
+
+
+atexit.register(flush)
@@ -5,6 +5,10 @@ import tempfile
 import shutil
 import sqlite3
 import json
+import time
+import io
+import queue
+import threading
 from unittest.mock import patch, MagicMock
 
 # Add the parent directory to sys.path so modules can be imported
@@ -12,8 +16,23 @@ sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")
 
 import database
 import file_handler
+import profiler
+import structured_log
 from app import app
 
+
+def setUpModule():
+    """Keep log records from the background writer off the real stdout"""
+    global original_log_stream
+    original_log_stream = structured_log.LOG_STREAM
+    structured_log.LOG_STREAM = io.StringIO()
+
+
+def tearDownModule():
+    """Write out anything still queued before restoring the log stream"""
+    structured_log.flush()
+    structured_log.LOG_STREAM = original_log_stream
+
 class TestDatabase(unittest.TestCase):
     """Test all database functions"""
     
@@ -144,5 +163,282 @@ class TestFileHandler(unittest.TestCase):
         self.assertFalse(file_handler.is_allowed_file('test'))
 
 
+class TestProfiler(unittest.TestCase):
+    """Test request profiling and slow request capture"""
+    
+    def setUp(self):
+        """Set up Flask test client with profiling enabled by token only"""
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        
+        self.test_db = 'test_profiler.db'
+        self.original_db = database.DATABASE_NAME
+        database.DATABASE_NAME = self.test_db
+        database.init_database()
+        
+        self.original_token = profiler.PROFILE_TOKEN
+        self.original_config = profiler.get_config()
+        profiler.PROFILE_TOKEN = 'secret'
+        self.token = {'X-Profile': 'secret'}
+        profiler.configure(sample_rate=0, mode='sampling', slow_request_ms=0)
+        profiler.clear_profiles()
+    
+    def tearDown(self):
+        """Restore profiler settings and clean up test database"""
+        profiler.PROFILE_TOKEN = self.original_token
+        profiler.configure(
+            sample_rate=self.original_config['sample_rate'],
+            mode=self.original_config['mode'],
+            slow_request_ms=self.original_config['slow_request_ms'],
+            buffer_size=self.original_config['buffer_size'],
+        )
+        profiler.clear_profiles()
+        database.DATABASE_NAME = self.original_db
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+    
+    def test_not_profiled_by_default(self):
+        """Test requests are not profiled without sampling, threshold or header"""
+        response = self.client.get('/list')
+        self.assertNotIn('X-Profile-Id', response.headers)
+        self.assertEqual(profiler.list_profiles(), [])
+    
+    def test_header_requires_token(self):
+        """Test the profiling header is ignored unless it carries the token"""
+        self.client.get('/list', headers={'X-Profile': 'wrong'})
+        self.assertEqual(profiler.list_profiles(), [])
+        
+        profiler.PROFILE_TOKEN = None
+        self.client.get('/list', headers={'X-Profile': 'secret'})
+        self.assertEqual(profiler.list_profiles(), [])
+    
+    def test_header_profiles_request_with_sql(self):
+        """Test a request profiled via header records its SQL statements"""
+        database.save_pdf_to_db('test.pdf', 'test.pdf', 'uploads/test.pdf')
+        response = self.client.get('/list', headers={'X-Profile': 'secret'})
+        profile_id = int(response.headers['X-Profile-Id'])
+        
+        response = self.client.get(f'/admin/profiles/{profile_id}', headers=self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment', response.headers['Content-Disposition'])
+        
+        data = json.loads(response.data)
+        self.assertEqual(data['reason'], 'requested')
+        self.assertEqual(data['route'], '/list')
+        self.assertEqual(data['status'], 200)
+        self.assertTrue(any('FROM pdfs' in sql['statement'] for sql in data['sql']))
+    
+    def test_cprofile_download(self):
+        """Test cProfile mode produces a report and a downloadable pstats file"""
+        profiler.configure(mode='cprofile')
+        response = self.client.get('/list', headers={'X-Profile': 'secret'})
+        profile_id = int(response.headers['X-Profile-Id'])
+        
+        data = json.loads(self.client.get(f'/admin/profiles/{profile_id}', headers=self.token).data)
+        self.assertEqual(data['mode'], 'cprofile')
+        self.assertIn('function calls', data['report'])
+        
+        response = self.client.get(f'/admin/profiles/{profile_id}.prof', headers=self.token)
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(len(response.data), 0)
+    
+    def test_sampled_requests(self):
+        """Test a sample rate of 1 profiles every request"""
+        profiler.configure(sample_rate=1)
+        self.client.get('/health')
+        
+        profiles = profiler.list_profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['reason'], 'sampled')
+    
+    def test_slow_request_capture(self):
+        """Test requests over the threshold are captured with their stacks"""
+        profiler.configure(slow_request_ms=20)
+        self.client.get('/health')
+        self.assertEqual(profiler.list_profiles(), [])
+        
+        with patch('app.get_all_pdfs', side_effect=lambda: time.sleep(0.1) or []):
+            self.client.get('/list')
+        
+        profiles = profiler.list_profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0]['reason'], 'slow')
+        self.assertGreater(profiles[0]['samples'], 0)
+        
+        stacks = profiler.get_profile(profiles[0]['id'])['stacks']
+        self.assertTrue(any('list_pdfs' in stack for stack in stacks))
+    
+    def test_ring_buffer_is_bounded(self):
+        """Test only the newest profiles are kept"""
+        profiler.configure(sample_rate=1, buffer_size=3)
+        for _ in range(5):
+            self.client.get('/health')
+        
+        response = self.client.get('/admin/profiles', headers=self.token)
+        data = json.loads(response.data)
+        self.assertEqual(len(data['profiles']), 3)
+        self.assertEqual(data['config']['buffer_size'], 3)
+    
+    def test_config_endpoint(self):
+        """Test profiling settings can be changed at runtime with the token"""
+        response = self.client.post('/admin/profiles/config', json={'sample_rate': 0.5})
+        self.assertEqual(response.status_code, 403)
+        
+        response = self.client.post('/admin/profiles/config', json={'sample_rate': 2},
+                                    headers={'X-Profile': 'secret'})
+        self.assertEqual(response.status_code, 400)
+        
+        response = self.client.post('/admin/profiles/config', json={'sample_rate': 0.5},
+                                    headers={'X-Profile': 'secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['sample_rate'], 0.5)
+        
+        response = self.client.post('/admin/profiles/config', json=[1],
+                                    headers={'X-Profile': 'secret'})
+        self.assertEqual(response.status_code, 400)
+        
+        invalid_bodies = [
+            '{"buffer_size": 1e400}',
+            '{"buffer_size": Infinity}',
+            '{"buffer_size": 1%s}' % ('0' * 400),
+            '{"buffer_size": 2.7}',
+            '{"slow_request_ms": NaN}',
+            '{"sample_rate": true}',
+            '{"sample_rate": "0.5"}',
+        ]
+        for body in invalid_bodies:
+            response = self.client.post('/admin/profiles/config', data=body,
+                                        content_type='application/json',
+                                        headers={'X-Profile': 'secret'})
+            self.assertEqual(response.status_code, 400, body)
+        self.assertEqual(profiler.get_config()['sample_rate'], 0.5)
+        
+        response = self.client.post('/admin/profiles/config', json={'buffer_size': 3.0},
+                                    headers={'X-Profile': 'secret'})
+        self.assertEqual(json.loads(response.data)['buffer_size'], 3)
+    
+    def test_profiles_require_token(self):
+        """Test captured profiles cannot be read without the token"""
+        response = self.client.get('/list', headers={'X-Profile': 'secret'})
+        profile_id = int(response.headers['X-Profile-Id'])
+        
+        self.assertEqual(self.client.get('/admin/profiles').status_code, 403)
+        self.assertEqual(self.client.get(f'/admin/profiles/{profile_id}').status_code, 403)
+        self.assertEqual(self.client.get(f'/admin/profiles/{profile_id}.prof',
+                                         headers={'X-Profile': 'wrong'}).status_code, 403)
+    
+    def test_profile_not_found(self):
+        """Test missing profiles return 404"""
+        self.assertEqual(self.client.get('/admin/profiles/999', headers=self.token).status_code, 404)
+        self.assertEqual(self.client.get('/admin/profiles/999.prof', headers=self.token).status_code, 404)
+
+
+class TestStructuredLog(unittest.TestCase):
+    """Test the queued JSON logging pipeline"""
+    
+    def setUp(self):
+        """Send log output to a buffer and use a test database"""
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        
+        self.test_db = 'test_log.db'
+        self.original_db = database.DATABASE_NAME
+        database.DATABASE_NAME = self.test_db
+        database.init_database()
+        
+        structured_log.flush()
+        self.stream = io.StringIO()
+        self.original_stream = structured_log.LOG_STREAM
+        structured_log.LOG_STREAM = self.stream
+    
+    def tearDown(self):
+        """Restore log output and clean up test database"""
+        structured_log.flush()
+        structured_log.LOG_STREAM = self.original_stream
+        database.DATABASE_NAME = self.original_db
+        if os.path.exists(self.test_db):
+            os.remove(self.test_db)
+    
+    def records(self):
+        """Flush the pipeline and parse everything written so far"""
+        self.assertTrue(structured_log.flush())
+        return [json.loads(line) for line in self.stream.getvalue().splitlines()]
+    
+    def test_request_record(self):
+        """Test each request logs route, latency and bytes with its request ID"""
+        response = self.client.get('/view/999', headers={'X-Request-ID': 'abc123'})
+        self.assertEqual(response.headers['X-Request-ID'], 'abc123')
+        
+        records = [r for r in self.records() if r['event'] == 'request']
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['request_id'], 'abc123')
+        self.assertEqual(records[0]['route'], '/view/<int:pdf_id>')
+        self.assertEqual(records[0]['status'], 302)
+        self.assertIn('latency_ms', records[0])
+        self.assertIn('bytes_out', records[0])
+    
+    def test_generated_request_id(self):
+        """Test requests without an ID get one, shared by nested records"""
+        with patch('app.save_uploaded_file', return_value=('test.pdf', 'uploads/test.pdf')):
+            response = self.client.post('/upload', data={'file': (io.BytesIO(b'%PDF'), 'test.pdf')})
+        request_id = response.headers['X-Request-ID']
+        
+        records = self.records()
+        events = {r['event']: r for r in records}
+        self.assertEqual(events['pdf_saved']['request_id'], request_id)
+        self.assertEqual(events['request']['request_id'], request_id)
+        self.assertGreater(events['request']['bytes_in'], 0)
+    
+    def test_sampling(self):
+        """Test a sample rate of zero drops the event unless forced"""
+        with patch.dict(structured_log.SAMPLE_RATES, {'noisy': 0.0}):
+            self.assertFalse(structured_log.log_event('noisy'))
+            self.assertTrue(structured_log.log_event('noisy', force=True))
+        
+        self.assertEqual(len([r for r in self.records() if r['event'] == 'noisy']), 1)
+    
+    def test_rate_limit(self):
+        """Test events over the per-second limit are suppressed"""
+        with patch.object(structured_log, 'LOG_RATE_LIMIT', 2):
+            results = [structured_log.log_event('burst', n=n) for n in range(5)]
+        
+        self.assertEqual(results, [True, True, False, False, False])
+        self.assertEqual(len([r for r in self.records() if r['event'] == 'burst']), 2)
+        self.assertEqual(structured_log.get_stats()['suppressed'], 3)
+        
+        structured_log.log_event('burst', force=True)
+        self.assertEqual(self.records()[-1]['suppressed'], 3)
+    
+    def test_drops_when_buffer_full(self):
+        """Test logging never blocks when the writer is stuck"""
+        entered = threading.Semaphore(0)
+        permits = threading.Semaphore(0)
+        
+        class SlowStream(io.StringIO):
+            def write(self, text):
+                entered.release()
+                permits.acquire(timeout=5)
+                return super().write(text)
+        
+        structured_log.LOG_STREAM = SlowStream()
+        structured_log.log_event('first', force=True)
+        self.assertTrue(entered.acquire(timeout=5))  # writer is now stuck on the stream
+        
+        with patch.object(structured_log, '_queue', queue.Queue(maxsize=3)):
+            results = [structured_log.log_event('flood', force=True) for _ in range(8)]
+            self.assertEqual(results, [True] * 3 + [False] * 5)
+            
+            # Let the writer drain the small queue, then hold it in write() so it
+            # picks up the real queue again once the patch is undone
+            permits.release()
+            self.assertTrue(entered.acquire(timeout=5))
+        
+        permits.release(100)
+        self.assertTrue(structured_log.flush(timeout=5))
+        
+        lines = [json.loads(line) for line in structured_log.LOG_STREAM.getvalue().splitlines()]
+        self.assertEqual([r['event'] for r in lines], ['first', 'flood', 'flood', 'flood', 'log_dropped'])
+        self.assertEqual(lines[-1]['count'], 5)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file